@@ -1,5 +1,7 @@
 import argparse
-import shutil
+import atexit
+import csv
+import hashlib
 import sys
 import os
 import random
@@ -10,6 +12,8 @@ import readline
 
 import pandas as pd
 import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from tqdm import tqdm
 import nibabel as nib
 import numpy as np
@@ -36,6 +40,12 @@ Adapted for segmentation by: Clemens Pollak
 Date: Sept-5-2023
 """
 
+# number of freeview windows that are open at the same time (the current one and the prefetched ones)
+PREFETCH_DEPTH = 3
+
+# temporary files (cached masks and their per-UID links) created in this session, removed at exit
+TMP_FILES = []
+
 
 def options_parse():
     """
@@ -66,18 +76,29 @@ def options_parse():
     return args
 
 
-def stop_labeling(processes: list):
+def stop_labeling(processes: list, exit_code: int = 0):
     """
     Stop labeling process,
     write leftover cases into the rest list - TODO: this should be done periodically to account for crashes
 
-    process: list of processes to terminate
+    process: list of processes (or futures of pending run_freeview calls) to terminate
     subject_list: cases still left 
     rest: filename of list to write the rest of the data to
+    exit_code: exit code of the program
     """
     print('[INFO] Stopping labeling')
 
+    # cancel all launches that have not started yet first, so the executor does not start them while we wait
     for p in processes:
+        if isinstance(p, Future):
+            p.cancel()
+
+    for p in processes:
+        if isinstance(p, Future):
+            # skip cancelled or failed launches, wait for the one in progress
+            if p.cancelled() or p.exception() is not None:
+                continue
+            p = p.result()[0]
         if sys.platform == "darwin":
             os.killpg(os.getpgid(p.pid), signal.SIGTERM)
         else:
@@ -85,7 +106,38 @@ def stop_labeling(processes: list):
 
     time.sleep(1)
 
-    sys.exit(0)
+    sys.exit(exit_code)
+
+
+def remove_tmp_files():
+    """
+    Remove the temporary files created in this session
+    """
+    for tmp_file in TMP_FILES:
+        try:
+            os.remove(tmp_file)
+        except FileNotFoundError:
+            pass
+
+
+def wait_for_window(uid, timeout=12):
+    """
+    Wait until the freeview window with the given UID is mapped
+
+    uid: UID contained in the window title
+    timeout: maximum time to wait in seconds
+
+    returns: X window ID of the window or None if it was not found before the timeout
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        result = subprocess.run(['xdotool', 'search', '--onlyvisible', '--name', f'UID: {uid}'], capture_output=True)
+        window_ids = result.stdout.decode().split()
+        if window_ids:
+            return window_ids[0]
+        time.sleep(0.05)
+
+    return None
 
 
 def run_freeview(diff_map_dir, subject_id, image, seg1, seg2, center, freesurfer_path, xdotool_installed):
@@ -95,6 +147,9 @@ def run_freeview(diff_map_dir, subject_id, image, seg1, seg2, center, freesurfer
     # create UID for the process
     uid = uuid.uuid4()
 
+    # voxel coordinates of the area of interest, used for both the mask and the initial slice
+    cx, cy, cz = int(round(center[0])), int(round(center[1])), int(round(center[2]))
+
     # print(subject_id)
     # print(image)
     # print(seg1)
@@ -108,53 +163,59 @@ def run_freeview(diff_map_dir, subject_id, image, seg1, seg2, center, freesurfer
 
 
 
-    # create mask around the area of interest
-    orig_image = nib.load(image)
-    mask = np.ones(orig_image.shape)
-    mask[int(center[0])-20:int(center[0])+20, int(center[1])-20:int(center[1])+20, int(center[2])-20:int(center[2])+20] = 0
-
-    if not os.path.isdir('/tmp/labeling'):
-        os.mkdir('/tmp/labeling/')
-
-    # save mask
-    mask_img = nib.Nifti1Image(mask, orig_image.affine, orig_image.header)
-    mask_file = os.path.join('/tmp', 'labeling', f'mask_{uid}.nii.gz')
-    nib.save(mask_img, mask_file)
-
-    # copy aseg files to /tmp
-
-    plt_path_seg1 = f'/tmp/labeling/{uid}_{subject_id}_seg1.mgz'
-    plt_path_seg2 = f'/tmp/labeling/{uid}_{subject_id}_seg2.mgz'
-    shutil.copy(seg1, plt_path_seg1)
-    shutil.copy(seg2, plt_path_seg2)
-
-
-
+    # masks only differ by the image grid and the position of the hole, so they are cached and shared between subjects
+    hdr_img = nib.load(image)
+    shape = hdr_img.shape
+    affine = hdr_img.affine
+    mask_key = hashlib.blake2b(f'{shape}_{affine.tobytes().hex()}_{cx//4}_{cy//4}_{cz//4}'.encode(),
+                               digest_size=8).hexdigest()
+    mask_file = os.path.join('/tmp', 'labeling', 'masks', f'{mask_key}.nii')
+
+    if not os.path.exists(mask_file):
+        # create mask around the area of interest (only the header is needed, voxel data is never read)
+        # 1 is drawn as overlay, 0 is the hole showing the area of interest. The mask is always 3D,
+        # even if the image has a trailing frame axis. It is only read locally by freeview, so it is saved uncompressed.
+        header = hdr_img.header.copy()
+        header.set_data_dtype(np.uint8)
+        mask = np.ones(shape[:3], dtype=np.uint8)
+        # clip at 0, a negative start would wrap around and leave the hole empty
+        mask[max(cx-20, 0):cx+20, max(cy-20, 0):cy+20, max(cz-20, 0):cz+20] = 0
+
+        # save mask (write to a temporary file first, so freeview never sees a partially written cache entry)
+        mask_img = nib.Nifti1Image(mask, affine, header)
+        tmp_mask_file = os.path.join('/tmp', 'labeling', 'masks', f'{mask_key}_{uid}.nii')
+        nib.save(mask_img, tmp_mask_file)
+        os.replace(tmp_mask_file, mask_file)
+        TMP_FILES.append(mask_file)
+
+    # every freeview process still gets its own mask path, pointing to the shared cache entry
+    mask_link = os.path.join('/tmp', 'labeling', f'mask_{uid}.nii')
+    os.symlink(mask_file, mask_link)
+    TMP_FILES.append(mask_link)
 
     cmd = [f'{freesurfer_path}/bin/freeview',
-            f'{image}:lock=1',
-            f'{diff_map_dir}/{subject_id}.nii.gz:colormap=jet:colorscale=0,1:visible=0:opacity=0.25:lock=1:name=difference_map' if args.diff_maps is not None else '',
-            f'{plt_path_seg1}:colormap=lut:name=1:visible=0:opacity=0.25',
-            f'{plt_path_seg2}:colormap=lut:name=2:visible=1:opacity=0.25',
-            f'{mask_file}:colormap=gecolor:colorscale=0,1:visible=1:opacity=0.3:lock=1:name=mask',
-            f'-slice {round(center[0])} {round(center[1])} {round(center[2])}',
-            f'-subtitle "{subject_id} - UID: {uid}"',
+           f'{image}:lock=1']
+    if diff_map_dir is not None:
+        cmd.append(f'{diff_map_dir}/{subject_id}.nii.gz:colormap=jet:colorscale=0,1:visible=0:opacity=0.25:lock=1:name=difference_map')
+    cmd += [f'{seg1}:colormap=lut:name=1:visible=0:opacity=0.25:lock=1',
+            f'{seg2}:colormap=lut:name=2:visible=1:opacity=0.25:lock=1',
+            f'{mask_link}:colormap=gecolor:colorscale=0,1:visible=1:opacity=0.3:lock=1:name=mask',
+            '-slice', str(cx), str(cy), str(cz),
+            '-subtitle', f'{subject_id} - UID: {uid}',
             '-cc',
-            '-zoom 4']
-        
-    
-
-    p = subprocess.Popen(' '.join(cmd), shell=True, stdout=subprocess.DEVNULL, preexec_fn=os.setpgrp if sys.platform == "darwin" else None)
+            '-zoom', '4']
 
-    # sleep one second
-    time.sleep(1)
+    # freeview is launched from a worker thread, so use start_new_session instead of preexec_fn (not thread-safe)
+    p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, start_new_session=sys.platform == "darwin")
 
+    # wait for the window to appear instead of sleeping a fixed time, the window ID is reused by all later window operations
+    wid = None
     if xdotool_installed:
-        window_hide_command = f'xdotool windowunmap --sync $(xdotool search --name "UID: {uid}")'
-        #print(window_hide_command)
-        subprocess.run(window_hide_command, shell=True)#, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wid = wait_for_window(uid)
+        if wid is not None:
+            subprocess.run(['xdotool', 'windowunmap', '--sync', wid])
 
-    return p, uid
+    return p, uid, wid
 
 
 def question_loop(p, methods):
@@ -310,16 +371,20 @@ if __name__ == '__main__':
     except FileNotFoundError:
         print('[WARNING] xdotool not installed. Please install xdotool to enable automatic window management.')
 
-    if args.fs is None:
-        if os.environ["FREESURFER_HOME"] is not None:
-            freesurfer_path = os.environ["FREESURFER_HOME"]
-        else:
-            paths_to_try = ['/groups/ag-reuter/software/centos/freesurfer741',
-                            '/Applications/freesurfer/7.1.1']
-            for p in paths_to_try:
-                if os.path.isdir(paths_to_try):
-                    freesurfer_path = p
-                    break
+    freesurfer_path = args.fs
+    if freesurfer_path is None:
+        freesurfer_path = os.environ.get('FREESURFER_HOME')
+    if freesurfer_path is None:
+        paths_to_try = ['/groups/ag-reuter/software/centos/freesurfer741',
+                        '/Applications/freesurfer/7.1.1']
+        for p in paths_to_try:
+            if os.path.isdir(p):
+                freesurfer_path = p
+                break
+
+    if freesurfer_path is None:
+        print('[ERROR] FreeSurfer home could not be determined. Please set FREESURFER_HOME or specify it with --fs')
+        sys.exit(1)
 
     if args.user is None:
         print('[ERROR] User name could not be determined. Please specify a user name with --user')
@@ -327,24 +392,32 @@ if __name__ == '__main__':
 
     print(f'[INFO] Labeling {args.met1} and {args.met2} as user {args.user}')
 
-    diff_areas = pd.read_csv(args.input_file, index_col='subject_id') # TODO: put dir
+    # directory for temporary freeview files (cached masks)
+    os.makedirs('/tmp/labeling/masks', exist_ok=True)
+    atexit.register(remove_tmp_files)
+
+    # only parse the columns used for labeling
+    diff_areas = pd.read_csv(args.input_file,
+                             usecols=['subject_id', 'ID', 'image', 'x1', 'y1', 'z1', args.met1, args.met2, 'num_differences'],
+                             index_col='subject_id') # TODO: put dir
     #diff_areas = diff_areas.sort_values(by='peak_value', ascending=False)
 
     # read subject names
-    num_subjects = len(diff_areas['ID'])
+    num_subjects = len(diff_areas)
     print(f'[INFO] Loaded list of {num_subjects} cases')
 
     
-    p_next = None
-    uid_next = None
+    # upcoming freeview windows are launched in the background while the current one is labeled
+    executor = ThreadPoolExecutor(max_workers=1)
 
     already_labeled = 0
 
     print(f'[INFO] saving results in {os.path.abspath(args.result)}')
 
-    if os.path.isfile(args.result):
-        with open(args.result, mode='r') as results_file:
-            already_labeled_subjs = pd.read_csv(results_file, header=None).iloc[:,0].tolist()
+    # the results file may exist but be empty if a previous session was stopped before the first label
+    if os.path.isfile(args.result) and os.path.getsize(args.result) > 0:
+        # only the subject column is needed, a set makes the membership test a hash lookup
+        already_labeled_subjs = set(pd.read_csv(args.result, header=None, usecols=[0])[0])
 
         # remove already labeled subjects
         before_del_len = len(diff_areas)
@@ -355,66 +428,57 @@ if __name__ == '__main__':
         
 
 
-    for (subject_id, row), (subject_id_next, row_next) in zip(diff_areas[:-1].iterrows(), diff_areas[1:].iterrows()):
-
-        num_differences = row['num_differences']        
-
-    
-        if p_next is None:
-            # intialize variables
-            method_idx = [0, 1]
-            method_names = [args.met1, args.met2]
-
-            # set first window
-            image = row['image']
-            center = row['x1'], row['y1'], row['z1']            
-            random.shuffle(method_idx)            
-            methods = [method_names[i] for i in method_idx]
-            segmentations = row[args.met1], row[args.met2]
-            segmentations = [segmentations[i] for i in method_idx]
-            p, uid = run_freeview(args.diff_maps, subject_id, image, segmentations[0], segmentations[1], center, freesurfer_path, xdotool_installed)
-
-            # set next window
-            image_next = row_next['image']
-            center_next = row_next['x1'], row_next['y1'], row_next['z1']
-            random.shuffle(method_idx)
-            methods_next = [method_names[i] for i in method_idx]
-            segmentations_next = row_next[args.met1], row_next[args.met2]
-            segmentations_next = [segmentations_next[i] for i in method_idx]
-            p_next, uid_next = run_freeview(args.diff_maps, subject_id_next, image_next, segmentations_next[0], segmentations_next[1], center_next, freesurfer_path, xdotool_installed)
-            print('initializing window ...')
-            for _ in tqdm(range(10)):
-                time.sleep(1.2)
-        else:
-            p = p_next
-            uid = uid_next
-            image, methods, segmentations = image_next, methods_next, segmentations_next
-            center = center_next
-
-            # set next window
-            image_next = row_next['image']
-            center_next = row_next['x1'], row_next['y1'], row_next['z1']
-            random.shuffle(method_idx)
-            methods_next = [method_names[i] for i in method_idx]
-            segmentations_next = row_next[args.met1], row_next[args.met2]
-            segmentations_next = [segmentations_next[i] for i in method_idx]
-            p_next, uid_next = run_freeview(args.diff_maps, subject_id_next, image_next, segmentations_next[0], segmentations_next[1], center_next, freesurfer_path, xdotool_installed)
-
+    # keep the results file open for the whole session
+    results_file = open(args.result, mode='a', newline='')
+    atexit.register(results_file.close)
+    results_writer = csv.writer(results_file, lineterminator='\n')
+
+    # extract the needed columns once, indexing NumPy rows is much cheaper than pandas' iterrows
+    subject_ids = diff_areas.index.to_numpy()
+    cols = diff_areas[['ID', 'image', 'x1', 'y1', 'z1', args.met1, args.met2, 'num_differences']].to_numpy()
+    method_names = (args.met1, args.met2)
+
+    # queue of (future, methods) for the subjects that are launched ahead of the current one
+    pending = deque()
+
+    for i in range(len(cols)):
+        # keep the pipeline filled, so freeview startup of upcoming subjects overlaps with labeling
+        for j in range(i + len(pending), min(i + PREFETCH_DEPTH, len(cols))):
+            row_j = cols[j]
+            # randomly swap the order in which the methods are shown
+            flip = random.getrandbits(1)
+            methods_j = method_names[::-1] if flip else method_names
+            segmentations_j = (row_j[6], row_j[5]) if flip else (row_j[5], row_j[6])
+            center_j = row_j[2], row_j[3], row_j[4]
+            pending.append((executor.submit(run_freeview, args.diff_maps, subject_ids[j], row_j[1], segmentations_j[0], segmentations_j[1], center_j, freesurfer_path, xdotool_installed),
+                            methods_j))
+
+        row = cols[i]
+        num_differences = row[7]
+
+        freeview, methods = pending.popleft()
+        try:
+            p, uid, wid = freeview.result()
+
+            if i == 0:
+                print('initializing window ...')
+                # with xdotool, run_freeview already waited for the window to appear
+                if not xdotool_installed:
+                    for _ in tqdm(range(10)):
+                        time.sleep(1.2)
+        except KeyboardInterrupt:
+            stop_labeling([freeview] + [f for f, _ in pending])
+        except Exception as e:
+            print(f'[ERROR] Could not launch freeview for {subject_ids[i]}: {e}')
+            stop_labeling([f for f, _ in pending], exit_code=1)
 
         labeling_start = time.time()
 
-        #print(uid, uid_next)
-
-        if xdotool_installed:
-            time.sleep(0.5)
-            show_window_command = f'xdotool windowmap $(xdotool search --name "UID: {uid}")'
-            #print(show_window_command)
-            subprocess.run(show_window_command, shell=True)#, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # the window already exists, run_freeview waited for it
+        if wid is not None:
+            subprocess.run(['xdotool', 'windowmap', wid])
     
-        best, confidence, difference_strength, fail, comment = question_loop([p, p_next], methods)
-
-        # sanitize comments field
-        comment = comment.replace(',', ';')
+        best, confidence, difference_strength, fail, comment = question_loop([p] + [f for f, _ in pending], methods)
 
         # log time
         label_time = time.time() - labeling_start
@@ -425,17 +489,16 @@ if __name__ == '__main__':
             os.killpg(os.getpgid(p.pid), signal.SIGTERM)
         else:
             p.send_signal(signal.SIGTERM)
-            if xdotool_installed:
-                window_close_command = f'xdotool search --name "UID: {uid}" windowclose'
-                #print(window_close_command)
-                subprocess.run(window_close_command, shell=True)
+            if wid is not None:
+                subprocess.run(['xdotool', 'windowclose', wid])
 
         already_labeled += 1
 
 
 
-        with open(args.result, mode='a', newline='') as results_file:
-            results_file.write(f"{row['ID']},{methods[0]},{methods[1]},{best},{confidence},{difference_strength},{fail},{comment},{args.user},{label_time},{num_differences}\n")
+        # flush after every case so no results are lost on a crash, csv.writer takes care of quoting the comment
+        results_writer.writerow([row[0], methods[0], methods[1], best, confidence, difference_strength, fail, comment, args.user, label_time, num_differences])
+        results_file.flush()
 
         print(f'[INFO] Labled {already_labeled}/{num_subjects} cases')
 